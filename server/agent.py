@@ -0,0 +1,251 @@
+import re
+import asyncio
+from functools import partial
+from datetime import datetime
+
+import orjson
+from cachetools import TTLCache
+from bson import ObjectId
+from pymongo import ReturnDocument
+import google.generativeai as genai
+
+# Logique IA (agent avec extraction JSON). genai doit être configuré
+# (genai.configure) par le module qui instancie l'agent.
+
+# Balises markdown ```json ... ``` que Gemini ajoute parfois autour du JSON
+_JSON_FENCE = re.compile(r'```json\s*|\s*```')
+
+def _empty_extraction():
+    return {"likes": [], "dislikes": []}
+
+class ExtractionBatcher:
+    """
+    Regroupe les extractions de préférences d'un même utilisateur. Le premier
+    message part tout de suite ; ceux qui arrivent pendant que Gemini répond
+    (au plus max_batch) sont envoyés ensemble dans un seul appel au tour suivant.
+    Les messages de comptes différents ne partagent jamais un prompt : un message
+    ne doit pas pouvoir influencer les préférences extraites pour un autre compte.
+    """
+    def __init__(self, model, max_batch=16):
+        self.model = model
+        self.max_batch = max_batch
+        self._loop = None
+        # user_id -> [(texte, Future)] en attente d'envoi
+        self._pending = {}
+        # user_id -> tâche qui vide la file de cet utilisateur
+        self._drains = {}
+
+    async def submit(self, user_id, text):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Nouvelle boucle (rechargement, tests) : l'état de l'ancienne est inutilisable
+            self._loop = loop
+            self._pending = {}
+            self._drains = {}
+        future = loop.create_future()
+        self._pending.setdefault(user_id, []).append((text, future))
+        if user_id not in self._drains:
+            self._drains[user_id] = loop.create_task(self._drain(user_id))
+        return await future
+
+    async def _drain(self, user_id):
+        try:
+            while self._pending.get(user_id):
+                queued = self._pending[user_id]
+                batch = queued[:self.max_batch]
+                self._pending[user_id] = queued[self.max_batch:]
+                try:
+                    await self._process(batch)
+                finally:
+                    # Aucun appelant ne doit rester bloqué si le traitement échoue
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(_empty_extraction())
+        finally:
+            self._drains.pop(user_id, None)
+            self._pending.pop(user_id, None)
+
+    async def _process(self, batch):
+        texts = [text for text, _ in batch]
+        if len(texts) == 1:
+            results = [await self._extract_one(texts[0])]
+        else:
+            results = await self._extract_many(texts)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _generate_json(self, prompt):
+        # Appel API pour l'extraction
+        response = await self.model.generate_content_async(prompt)
+        raw_text = response.text.strip()
+        
+        # Nettoyage au cas où Gemini ajoute des balises markdown ```json ... ```
+        clean_text = _JSON_FENCE.sub('', raw_text)
+        
+        return orjson.loads(clean_text)
+
+    async def _extract_one(self, text):
+        extraction_prompt = (
+            f"Analyse le message suivant de l'utilisateur. Ton but est d'extraire ses goûts (likes) "
+            f"et ce qu'il n'aime pas (dislikes) s'ils sont mentionnés explicitement.\n"
+            f"Message utilisateur : \"{text}\"\n\n"
+            f"Réponds UNIQUEMENT avec un objet JSON valide suivant ce format exact (sans markdown, sans texte autour) :\n"
+            f'{{"likes": ["item1", "item2"], "dislikes": ["item3"]}}\n'
+            f"Si aucune information n'est trouvée, renvoie des listes vides."
+        )
+
+        try:
+            data = await self._generate_json(extraction_prompt)
+            return data if isinstance(data, dict) else _empty_extraction()
+        except Exception as e:
+            print(f"Erreur extraction JSON : {e}")
+            return _empty_extraction()
+
+    async def _extract_many(self, texts):
+        inputs = "\n".join(f"Message {i} : \"{text}\"" for i, text in enumerate(texts, 1))
+        extraction_prompt = (
+            f"Analyse chacun des {len(texts)} messages suivants d'un même utilisateur, indépendamment. "
+            f"Pour chacun, extrais ses goûts (likes) et ce qu'il n'aime pas (dislikes) "
+            f"s'ils sont mentionnés explicitement.\n"
+            f"{inputs}\n\n"
+            f"Réponds UNIQUEMENT avec un tableau JSON valide de {len(texts)} objets, dans l'ordre des messages, "
+            f"suivant ce format exact (sans markdown, sans texte autour) :\n"
+            f'[{{"likes": ["item1"], "dislikes": ["item2"]}}, {{"likes": [], "dislikes": []}}]\n'
+            f"Si aucune information n'est trouvée pour un message, renvoie des listes vides."
+        )
+
+        try:
+            data = await self._generate_json(extraction_prompt)
+            if isinstance(data, list) and len(data) == len(texts):
+                return [item if isinstance(item, dict) else _empty_extraction() for item in data]
+            print("Erreur extraction JSON : réponse groupée incohérente, repli message par message")
+        except Exception as e:
+            print(f"Erreur extraction JSON groupée : {e}")
+        return await asyncio.gather(*(self._extract_one(text) for text in texts))
+
+class AIAgent:
+    # Court : chaque worker a son propre cache, qui n'est pas invalidé par les autres
+    MEMORY_CACHE_TTL_SECONDS = 30
+
+    def __init__(self, db_instance):
+        self.memory_col = db_instance["user_memory"]
+        # On utilise le modèle flash qui est rapide et efficace pour l'extraction
+        self.model = genai.GenerativeModel("gemini-2.0-flash")
+        self.extractor = ExtractionBatcher(self.model)
+        # user_id -> {"likes", "dislikes"} : évite de relire la mémoire à chaque tour
+        self.memories = TTLCache(maxsize=1000, ttl=self.MEMORY_CACHE_TTL_SECONDS)
+        # Références fortes vers les écritures lancées en arrière-plan
+        self._background_tasks = set()
+
+    async def get_memory(self, user_id):
+        mem = self.memories.get(user_id)
+        if mem is None:
+            mem = await self.memory_col.find_one(
+                {"user_id": ObjectId(user_id)},
+                {"_id": 0, "likes": 1, "dislikes": 1}
+            )
+            mem = mem if mem else {"likes": [], "dislikes": []}
+            self.memories[user_id] = mem
+        return mem
+
+    async def update_pref(self, user_id, likes, dislikes):
+        add_to_set = {}
+        if likes:
+            add_to_set["likes"] = {"$each": likes} # $each pour ajouter une liste
+        if dislikes:
+            add_to_set["dislikes"] = {"$each": dislikes}
+        if add_to_set:
+            # Mise à jour et relecture en un seul aller-retour : le document après
+            # modification remplace la mémoire en cache
+            mem = await self.memory_col.find_one_and_update(
+                {"user_id": ObjectId(user_id)},
+                {"$addToSet": add_to_set, "$set": {"updated_at": datetime.utcnow()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+                projection={"_id": 0, "likes": 1, "dislikes": 1},
+            )
+            self.memories[user_id] = {
+                "likes": mem.get("likes", []),
+                "dislikes": mem.get("dislikes", []),
+            }
+
+    def _run_in_background(self, user_id, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(partial(self._on_background_done, user_id))
+
+    def _on_background_done(self, user_id, task):
+        self._background_tasks.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            error = "annulée" if task.cancelled() else task.exception()
+            print(f"Erreur mise à jour mémoire : {error}")
+            # La valeur provisoire en cache n'a pas été enregistrée : on la jette
+            self.memories.pop(user_id, None)
+
+    async def extract_info_as_json(self, user_id, text):
+        """
+        Demande à Gemini d'analyser le texte et de renvoyer un JSON strict.
+        Les messages rapprochés d'un même utilisateur sont regroupés par l'ExtractionBatcher.
+        """
+        return await self.extractor.submit(user_id, text)
+
+    def build_context_prompt(self, likes, dislikes):
+        all_likes = ", ".join(likes)
+        all_dislikes = ", ".join(dislikes)
+        return (
+            f"Tu es un assistant personnel intelligent.\n"
+            f"CONTEXTE MÉMOIRE SUR L'UTILISATEUR :\n"
+            f"- Aime : {all_likes if all_likes else 'Rien de connu'}\n"
+            f"- N'aime pas : {all_dislikes if all_dislikes else 'Rien de connu'}\n\n"
+            f"Consigne : Réponds naturellement au dernier message de l'utilisateur. "
+            f"Utilise le contexte mémoire pour personnaliser ta réponse si pertinent."
+        )
+
+    async def process_message(self, user_id, text):
+        system_note = ""
+        
+        # 1. Analyse (Extraction JSON) et lecture de la mémoire (en cache le plus souvent)
+        extracted_data, mem = await asyncio.gather(
+            self.extract_info_as_json(user_id, text),
+            self.get_memory(user_id),
+        )
+        
+        new_likes = extracted_data.get("likes", [])
+        new_dislikes = extracted_data.get("dislikes", [])
+        
+        # 2. Mise à jour de la DB en arrière-plan : la réponse n'attend pas l'écriture
+        if new_likes or new_dislikes:
+            self._run_in_background(user_id, self.update_pref(user_id, new_likes, new_dislikes))
+
+        if new_likes:
+            system_note += f"(J'ai noté que vous aimez : {', '.join(new_likes)}) "
+        
+        if new_dislikes:
+            system_note += f"(J'ai noté que vous n'aimez pas : {', '.join(new_dislikes)})"
+
+        # 3. Contexte complet : mémoire lue + nouvelles préférences fusionnées localement
+        likes = list(dict.fromkeys(mem.get("likes", []) + new_likes))
+        dislikes = list(dict.fromkeys(mem.get("dislikes", []) + new_dislikes))
+        if new_likes or new_dislikes:
+            # Valeur provisoire, remplacée par le résultat de update_pref
+            self.memories[user_id] = {"likes": likes, "dislikes": dislikes}
+        
+        # 4. Génération de la réponse conversationnelle
+        context_prompt = self.build_context_prompt(likes, dislikes)
+        
+        full_prompt = f"{context_prompt}\n\nUtilisateur: {text}\nAssistant:"
+        
+        try:
+            response = await self.model.generate_content_async(full_prompt)
+            final_response = response.text
+            
+            # On ajoute une petite note système au début si on a appris quelque chose
+            # (Optionnel, mais utile pour le debug visuel dans le chat)
+            if system_note:
+                final_response = f"_{system_note}_\n\n{final_response}"
+                
+            return final_response
+        except Exception as e:
+            print(f"Erreur réponse Gemini : {e}")
+            return "Désolé, je rencontre un problème technique."
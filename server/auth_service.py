@@ -1,20 +1,33 @@
 import os
-import json
-import re
+import time
+import hashlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException, Depends, status
+from cachetools import TTLCache, TLRUCache
+
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, status
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, EmailStr
 from pydantic_settings import BaseSettings
-from pymongo import MongoClient, ASCENDING
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING
+from pymongo.monitoring import ConnectionPoolListener, ConnectionCheckOutFailedReason
+from pymongo.errors import DuplicateKeyError
 import bcrypt
-from jose import jwt, JWTError
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+import jwt
+from jwt import PyJWTError
 from bson import ObjectId
 import google.generativeai as genai
 
+from agent import AIAgent
+
 # --- 1. CONFIGURATION ---
 class Settings(BaseSettings):
     MONGO_URI: str
@@ -22,6 +35,17 @@ class Settings(BaseSettings):
     GEMINI_API_KEY: str
     JWT_ALGORITHM: str = "HS256"
     JWT_EXP_DELTA_SECONDS: int = 3600
+    MONGO_MAX_POOL_SIZE: int = 50
+    MONGO_MIN_POOL_SIZE: int = 5
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: int = 1000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 2000
+    MONGO_COMPRESSORS: str = "zstd"
+    # Coût du hachage argon2id : plus élevé = plus sûr, mais moins de logins/s par cœur
+    ARGON2_TIME_COST: int = 2
+    # Mémoire par hash ; pic ≈ taille de HASH_POOL × ARGON2_MEMORY_COST_KIB
+    ARGON2_MEMORY_COST_KIB: int = 64 * 1024
+    # Threads par hash ; HASH_POOL compte cpu_count() // ARGON2_PARALLELISM workers
+    ARGON2_PARALLELISM: int = 2
     
     class Config:
         env_file = ".env"
@@ -33,114 +57,48 @@ settings = Settings()
 genai.configure(api_key=settings.GEMINI_API_KEY)
 
 # --- 2. BASE DE DONNÉES ---
-client = MongoClient(settings.MONGO_URI)
+class PoolSaturationListener(ConnectionPoolListener):
+    """Signale quand une requête n'obtient pas de connexion (pool saturé)."""
+    def connection_check_out_failed(self, event):
+        if event.reason == ConnectionCheckOutFailedReason.TIMEOUT:
+            print(f"Pool Mongo saturé ({event.address}) : attente > {settings.MONGO_WAIT_QUEUE_TIMEOUT_MS}ms")
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_checked_out(self, event): pass
+    def connection_checked_in(self, event): pass
+
+# Pool borné et réutilisé : on échoue vite en cas de saturation plutôt que
+# de faire attendre toute la réponse.
+client = AsyncIOMotorClient(
+    settings.MONGO_URI,
+    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+    waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    compressors=settings.MONGO_COMPRESSORS,
+    event_listeners=[PoolSaturationListener()],
+)
 db = client["user_agent_db"]
 users_collection = db["users"]
 memory_collection = db["user_memory"]
+meta_collection = db["_meta"]
 
-users_collection.create_index([("email", ASCENDING)], unique=True)
-memory_collection.create_index([("user_id", ASCENDING)], unique=True)
-
-# --- 3. LOGIQUE IA (AGENT AVEC EXTRACTION JSON) ---
-class AIAgent:
-    def __init__(self, db_instance):
-        self.memory_col = db_instance["user_memory"]
-        # On utilise le modèle flash qui est rapide et efficace pour l'extraction
-        self.model = genai.GenerativeModel("gemini-2.0-flash")
-
-    def get_memory(self, user_id):
-        mem = self.memory_col.find_one({"user_id": ObjectId(user_id)})
-        return mem if mem else {"likes": [], "dislikes": []}
-
-    def update_pref(self, user_id, category, items):
-        if items:
-            self.memory_col.update_one(
-                {"user_id": ObjectId(user_id)},
-                {"$addToSet": {category: {"$each": items}}}, # $each pour ajouter une liste
-                upsert=True
-            )
-
-    def extract_info_as_json(self, text):
-        """
-        Demande à Gemini d'analyser le texte et de renvoyer un JSON strict.
-        """
-        extraction_prompt = (
-            f"Analyse le message suivant de l'utilisateur. Ton but est d'extraire ses goûts (likes) "
-            f"et ce qu'il n'aime pas (dislikes) s'ils sont mentionnés explicitement.\n"
-            f"Message utilisateur : \"{text}\"\n\n"
-            f"Réponds UNIQUEMENT avec un objet JSON valide suivant ce format exact (sans markdown, sans texte autour) :\n"
-            f'{{"likes": ["item1", "item2"], "dislikes": ["item3"]}}\n'
-            f"Si aucune information n'est trouvée, renvoie des listes vides."
-        )
-
-        try:
-            # Appel API pour l'extraction
-            response = self.model.generate_content(extraction_prompt)
-            raw_text = response.text.strip()
-            
-            # Nettoyage au cas où Gemini ajoute des balises markdown ```json ... ```
-            clean_text = re.sub(r'```json\s*|\s*```', '', raw_text)
-            
-            data = json.loads(clean_text)
-            return data
-        except Exception as e:
-            print(f"Erreur extraction JSON : {e}")
-            return {"likes": [], "dislikes": []}
-
-    def process_message(self, user_id, text):
-        system_note = ""
-        
-        # 1. Étape d'Analyse (Extraction JSON)
-        extracted_data = self.extract_info_as_json(text)
-        
-        new_likes = extracted_data.get("likes", [])
-        new_dislikes = extracted_data.get("dislikes", [])
-        
-        # 2. Mise à jour de la DB
-        if new_likes:
-            self.update_pref(user_id, "likes", new_likes)
-            system_note += f"(J'ai noté que vous aimez : {', '.join(new_likes)}) "
-        
-        if new_dislikes:
-            self.update_pref(user_id, "dislikes", new_dislikes)
-            system_note += f"(J'ai noté que vous n'aimez pas : {', '.join(new_dislikes)})"
-
-        # 3. Récupération du contexte complet (mémoire mise à jour)
-        mem = self.get_memory(user_id)
-        all_likes = ", ".join(mem.get("likes", []))
-        all_dislikes = ", ".join(mem.get("dislikes", []))
-        
-        # 4. Génération de la réponse conversationnelle
-        context_prompt = (
-            f"Tu es un assistant personnel intelligent.\n"
-            f"CONTEXTE MÉMOIRE SUR L'UTILISATEUR :\n"
-            f"- Aime : {all_likes if all_likes else 'Rien de connu'}\n"
-            f"- N'aime pas : {all_dislikes if all_dislikes else 'Rien de connu'}\n\n"
-            f"Consigne : Réponds naturellement au dernier message de l'utilisateur. "
-            f"Utilise le contexte mémoire pour personnaliser ta réponse si pertinent."
-        )
-        
-        full_prompt = f"{context_prompt}\n\nUtilisateur: {text}\nAssistant:"
-        
-        try:
-            response = self.model.generate_content(full_prompt)
-            final_response = response.text
-            
-            # On ajoute une petite note système au début si on a appris quelque chose
-            # (Optionnel, mais utile pour le debug visuel dans le chat)
-            if system_note:
-                final_response = f"_{system_note}_\n\n{final_response}"
-                
-            return final_response
-        except Exception as e:
-            print(f"Erreur réponse Gemini : {e}")
-            return "Désolé, je rencontre un problème technique."
+# À incrémenter à chaque modification des index ci-dessous (voir init_indexes)
+INDEXES_VERSION = 1
 
+# --- 3. LOGIQUE IA (voir agent.py) ---
 # Initialisation de l'agent
 agent = AIAgent(db)
 
 # --- 4. FASTAPI SETUP ---
-app = FastAPI(title="SMA Unified API")
+app = FastAPI(title="SMA Unified API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -150,6 +108,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def warm_mongo_pool():
+    # Ouvre les premières connexions avant la première requête
+    await client.admin.command("ping")
+
+@app.on_event("startup")
+async def init_indexes():
+    # La sentinelle n'est écrite qu'une fois les index créés : un worker interrompu
+    # en cours de route laisse le prochain démarrage les reconstruire. Plusieurs
+    # workers peuvent les créer en même temps, create_index est idempotent.
+    sentinel_id = f"indexes_v{INDEXES_VERSION}"
+    if await meta_collection.find_one({"_id": sentinel_id}):
+        return
+
+    await users_collection.create_index([("email", ASCENDING)], unique=True)
+    await memory_collection.create_index([("user_id", ASCENDING)], unique=True)
+    await meta_collection.update_one(
+        {"_id": sentinel_id},
+        {"$setOnInsert": {"created_at": datetime.utcnow()}},
+        upsert=True
+    )
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # --- 5. MODÈLES & UTILITAIRES ---
@@ -166,11 +146,60 @@ class TokenResponse(BaseModel):
 class ChatRequest(BaseModel):
     message: str
 
-def hash_password(plain_password: str) -> bytes:
-    return bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt())
+# argon2id remplace bcrypt pour les nouveaux mots de passe. Le hachage reste
+# coûteux en CPU : on l'exécute dans un pool de threads pour ne pas bloquer la
+# boucle d'événements (argon2-cffi et bcrypt libèrent le GIL).
+# Les paramètres de coût sont lus une seule fois au démarrage (voir Settings).
+password_hasher = PasswordHasher(
+    time_cost=settings.ARGON2_TIME_COST,
+    memory_cost=settings.ARGON2_MEMORY_COST_KIB,
+    parallelism=settings.ARGON2_PARALLELISM,
+)
+
+# Un hash argon2 occupe déjà ARGON2_PARALLELISM cœurs : on ne lance pas plus de
+# hash simultanés que de cœurs disponibles, ce qui borne aussi la mémoire.
+HASH_POOL_SIZE = max(1, (os.cpu_count() or 1) // settings.ARGON2_PARALLELISM)
+HASH_POOL = ThreadPoolExecutor(max_workers=HASH_POOL_SIZE)
+# File d'attente bornée à quelques hash par worker : à ~100ms par hash argon2,
+# l'attente maximale reste autour d'une seconde avant de renvoyer un 503.
+HASH_QUEUE_PER_WORKER = 10
+HASH_MAX_QUEUE = HASH_POOL_SIZE * HASH_QUEUE_PER_WORKER
+
+BCRYPT_PREFIXES = (b"$2a$", b"$2b$", b"$2y$")
+
+async def run_hasher(func, *args):
+    # Backpressure : si trop de hash sont en attente, on refuse plutôt que de
+    # laisser les temps de réponse exploser.
+    if HASH_POOL._work_queue.qsize() > HASH_MAX_QUEUE:
+        raise HTTPException(
+            status_code=503,
+            detail="Serveur surchargé, réessayez.",
+            headers={"Retry-After": "1"},
+        )
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(HASH_POOL, func, *args)
+
+def is_legacy_hash(hashed) -> bool:
+    """Les anciens comptes ont un hash bcrypt stocké en bytes."""
+    return isinstance(hashed, bytes) and hashed.startswith(BCRYPT_PREFIXES)
+
+def needs_rehash(hashed) -> bool:
+    """Hash bcrypt, ou hash argon2 calculé avec d'autres paramètres de coût."""
+    return is_legacy_hash(hashed) or password_hasher.check_needs_rehash(hashed)
 
-def verify_password(plain_password: str, hashed: bytes) -> bool:
-    return bcrypt.checkpw(plain_password.encode("utf-8"), hashed)
+def _verify_sync(plain_password: str, hashed) -> bool:
+    if is_legacy_hash(hashed):
+        return bcrypt.checkpw(plain_password.encode("utf-8"), hashed)
+    try:
+        return password_hasher.verify(hashed, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+async def hash_password(plain_password: str) -> str:
+    return await run_hasher(password_hasher.hash, plain_password)
+
+async def verify_password(plain_password: str, hashed) -> bool:
+    return await run_hasher(_verify_sync, plain_password, hashed)
 
 def create_token(user_id: str) -> str:
     exp = datetime.utcnow() + timedelta(seconds=settings.JWT_EXP_DELTA_SECONDS)
@@ -178,68 +207,176 @@ def create_token(user_id: str) -> str:
     token = jwt.encode(payload, settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM)
     return token
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+# Cache des JWT déjà validés, partagé par toutes les requêtes du process.
+# Clé = SHA-256 du token brut, pour ne pas garder les tokens en clair en mémoire.
+# Chaque entrée expire exactement à l'"exp" du token (horloge murale, comme exp).
+JWT_CACHE_DEFAULT_TTL_SECONDS = 60
+_jwt_cache = TLRUCache(
+    maxsize=10000,
+    ttu=lambda key, value, now: value["exp"],
+    timer=time.time,
+)
+
+def decode_token(token: str) -> dict:
+    """
+    Décode et vérifie un JWT. Les tokens valides sont mis en cache jusqu'à leur
+    propre expiration (ou JWT_CACHE_DEFAULT_TTL_SECONDS s'ils n'ont pas d'exp).
+    """
+    key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    entry = _jwt_cache.get(key)
+    if entry is not None:
+        return entry["payload"]
+
+    # Lève PyJWTError si le token est invalide : rien n'est mis en cache dans ce cas
+    payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+    exp = payload.get("exp", time.time() + JWT_CACHE_DEFAULT_TTL_SECONDS)
+    _jwt_cache[key] = {"payload": payload, "exp": exp}
+    return payload
+
+# Cache court des utilisateurs authentifiés : évite un aller-retour Mongo par
+# requête. À invalider (_user_cache.pop) dès qu'un document utilisateur change.
+USER_CACHE_TTL_SECONDS = 30
+_user_cache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL_SECONDS)
+
+async def get_user_by_id(user_id: str) -> Optional[dict]:
+    user = _user_cache.get(user_id)
+    if user is None:
+        doc = await users_collection.find_one(
+            {"_id": ObjectId(user_id)},
+            {"email": 1, "name": 1}
+        )
+        if not doc:
+            return None
+        user = {
+            "_id": doc["_id"],
+            "id": str(doc["_id"]),
+            "email": doc["email"],
+            "name": doc.get("name"),
+        }
+        _user_cache[user_id] = user
+    return dict(user)
+
+async def get_user_with_memory(user_id: str) -> Optional[dict]:
+    """Charge l'utilisateur et sa mémoire en un seul aller-retour ($lookup)."""
+    pipeline = [
+        {"$match": {"_id": ObjectId(user_id)}},
+        {"$lookup": {
+            "from": "user_memory",
+            "localField": "_id",
+            "foreignField": "user_id",
+            "as": "memory",
+        }},
+        {"$project": {
+            "_id": 0,
+            "email": 1,
+            "name": 1,
+            "updated_at": {"$ifNull": ["$updated_at", "$created_at"]},
+            "memory": {
+                "likes": {"$first": "$memory.likes"},
+                "dislikes": {"$first": "$memory.dislikes"},
+                "updated_at": {"$first": "$memory.updated_at"},
+            },
+        }},
+    ]
+    docs = await users_collection.aggregate(pipeline).to_list(length=1)
+    return docs[0] if docs else None
+
+def profile_etag(user_id: str, user: dict) -> str:
+    """ETag de /me : change dès que l'utilisateur ou sa mémoire est modifié."""
+    mem = user.get("memory") or {}
+    raw = f"{user_id}:{user.get('updated_at')}:{mem.get('updated_at')}"
+    return '"' + hashlib.md5(raw.encode("utf-8"), usedforsecurity=False).hexdigest() + '"'
+
+async def get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
+    """Vérifie le token et renvoie l'id utilisateur, sans lecture en base."""
     try:
-        payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
-        user_id = payload.get("sub")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Token invalide")
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
-        if not user:
-            raise HTTPException(status_code=401, detail="Utilisateur introuvable")
-        user["id"] = str(user["_id"])
-        return user
-    except JWTError:
+        payload = decode_token(token)
+    except PyJWTError:
+        raise HTTPException(status_code=401, detail="Token invalide")
+    user_id = payload.get("sub")
+    if not user_id:
         raise HTTPException(status_code=401, detail="Token invalide")
+    return user_id
+
+async def get_current_user(user_id: str = Depends(get_current_user_id)):
+    user = await get_user_by_id(user_id)
+    if not user:
+        raise HTTPException(status_code=401, detail="Utilisateur introuvable")
+    return user
 
 # --- 6. ROUTES ---
 
 @app.post("/signup", status_code=201)
-def signup(payload: SignupModel):
-    if users_collection.find_one({"email": payload.email}):
-        raise HTTPException(status_code=400, detail="Email déjà utilisé.")
-
-    hashed = hash_password(payload.password)
+async def signup(payload: SignupModel):
+    hashed = await hash_password(payload.password)
+    now = datetime.utcnow()
     user_doc = {
         "email": payload.email,
         "password_hash": hashed,
         "name": payload.name,
-        "created_at": datetime.utcnow()
+        "created_at": now,
+        "updated_at": now
     }
-    res = users_collection.insert_one(user_doc)
-    
-    memory_collection.insert_one({
-        "user_id": res.inserted_id,
-        "likes": [],
-        "dislikes": [],
-        "updated_at": datetime.utcnow()
-    })
+    # L'index unique sur l'email détecte les doublons : pas de find_one préalable
+    try:
+        res = await users_collection.insert_one(user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email déjà utilisé.")
+
+    # Le document user_memory est créé à la première préférence (upsert dans
+    # AIAgent.update_pref) ; les lectures traitent son absence comme une mémoire vide.
 
     return {"msg": "Compte créé", "user_id": str(res.inserted_id)}
 
 @app.post("/token", response_model=TokenResponse)
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = users_collection.find_one({"email": form_data.username})
-    if not user or not verify_password(form_data.password, user["password_hash"]):
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await users_collection.find_one(
+        {"email": form_data.username},
+        {"_id": 1, "email": 1, "password_hash": 1}
+    )
+    if not user or not await verify_password(form_data.password, user["password_hash"]):
         raise HTTPException(status_code=400, detail="Identifiants invalides.")
 
+    # Migration progressive : on rehache les anciens hash bcrypt, et les hash
+    # argon2 dont le coût ne correspond plus à la configuration
+    if needs_rehash(user["password_hash"]):
+        new_hash = await hash_password(form_data.password)
+        await users_collection.update_one(
+            {"_id": user["_id"]},
+            {"$set": {"password_hash": new_hash}}
+        )
+        _user_cache.pop(str(user["_id"]), None)
+
     token = create_token(str(user["_id"]))
     return {"access_token": token, "expires_in": settings.JWT_EXP_DELTA_SECONDS}
 
 @app.get("/me")
-def read_my_profile(current_user: dict = Depends(get_current_user)):
-    mem = memory_collection.find_one({"user_id": ObjectId(current_user["id"])})
-    return {
-        "email": current_user["email"],
-        "name": current_user.get("name"),
-        "memory": {
-            "likes": mem.get("likes", []) if mem else [],
-            "dislikes": mem.get("dislikes", []) if mem else []
-        }
-    }
+async def read_my_profile(request: Request, user_id: str = Depends(get_current_user_id)):
+    user = await get_user_with_memory(user_id)
+    if not user:
+        raise HTTPException(status_code=401, detail="Utilisateur introuvable")
+
+    # Profil inchangé depuis la dernière lecture du client : 304 sans corps
+    etag = profile_etag(user_id, user)
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    mem = user.get("memory")
+    return ORJSONResponse(
+        {
+            "email": user["email"],
+            "name": user.get("name"),
+            "memory": {
+                "likes": mem.get("likes", []) if mem else [],
+                "dislikes": mem.get("dislikes", []) if mem else []
+            }
+        },
+        headers={"ETag": etag},
+    )
 
 @app.post("/chat")
-def chat(payload: ChatRequest, current_user: dict = Depends(get_current_user)):
+async def chat(payload: ChatRequest, current_user: dict = Depends(get_current_user)):
     """Route de chat avec IA 'augmentée' par l'extraction JSON"""
-    response = agent.process_message(current_user["id"], payload.message)
+    response = await agent.process_message(current_user["id"], payload.message)
     return {"response": response}
\ No newline at end of file
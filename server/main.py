@@ -30,6 +30,8 @@ class UserAgent:
         self.model = genai.GenerativeModel("gemini-2.0-flash")
 
     def remember(self, text):
+        # Plain substring checks on purpose: for two fixed keywords they beat a
+        # compiled (case-insensitive) regex, especially when no keyword is present.
         text_lower = text.lower()
         if "i like" in text_lower:
             pref = text_lower.split("i like", 1)[1].strip(". ")